@@ -3,9 +3,33 @@
 Reads most files supplied.
 """
 
-from utils.any2md import file2md
-from utils.md2ssml import md2ssml
-from utils.ssml2audio import ssml2audio
+from utils.any2md import file2md, file_sections, text_sections, MAPPABLE
+from utils.boilerplate import remove_boilerplate
+from utils.md2ssml import sections2ssml
+from utils.scheduler import QuotaScheduler
+from utils.spool import submit
+from utils.ssml2audio import ssml2audio, PROFILES, BACKENDS
+from utils.tts_preprocess import TTSPreprocessor
+
+
+def document_sections(path, keep_boilerplate=False):
+    """
+    Reads a document as markdown sections. Markdown and plain text are read one section at a time.
+
+    :param path: path to input file
+    :param keep_boilerplate: bool: do not remove running headers, footers and page numbers of pdf pages
+    :return: iterable of str: markdown sections
+    """
+    ext = path.split('.')[-1].lower()
+    if ext in MAPPABLE:
+        return file_sections(path)
+
+    md = file2md(path)
+    # only pdf pages have running headers and footers
+    if ext == 'pdf' and not keep_boilerplate:
+        md = remove_boilerplate(md)
+    return text_sections(md)
+
 
 if __name__ == '__main__':
     import argparse
@@ -14,8 +38,69 @@ if __name__ == '__main__':
     logging.getLogger().setLevel(logging.INFO)
 
     args = argparse.ArgumentParser(description='Converts most files to audio.')
-    args.add_argument('path', help='path to the file to be converted to audio')
+    args.add_argument('path', nargs='+', help='paths to the files to be converted to audio, several files are '
+                                              'synthesized at the same time sharing the TTS quota')
+    args.add_argument('--keep-boilerplate', action='store_true',
+                      help='do not remove running headers, footers and page numbers of pdf pages')
+    args.add_argument('--no-compact', action='store_true', help='keep ssml markup with no audible effect')
+    args.add_argument('--correction-index', help='path to a SymSpell index built by utils/symspell.py, '
+                                                 'used for autocorrect instead of enchant')
+    args.add_argument('--profile', choices=PROFILES.keys(), default='mp3', help='audio encoding profile')
+    args.add_argument('--sample-rate', type=int,
+                      help='sample rate in Hz, defaults to 24000 for wav and 16000 for opus')
+    args.add_argument('--backend', choices=BACKENDS.keys(), default='google', help='synthesis backend')
+    args.add_argument('--hedge', action='store_true', help='send a duplicate request when a request is slow')
+    args.add_argument('--incremental', action='store_true',
+                      help='keep synthesized chunks, after an edit only the changed chunks are synthesized')
+    args.add_argument('--spool', help='submit the document to a spool directory for utils/spool.py workers '
+                                      'instead of synthesizing it')
 
     args = args.parse_args()
 
-    ssml2audio(md2ssml(file2md(args.path)), '.'.join(args.path.split('.')[:-1]))
+    def convert(path):
+        # documents are processed lazily one section at a time, each with its own preprocessor
+        # so that documents can be converted in parallel
+        preprocessor = TTSPreprocessor(correction_index=args.correction_index)
+        ssml = sections2ssml(document_sections(path, args.keep_boilerplate), preprocessor,
+                             compact=not args.no_compact)
+        outfile = '.'.join(path.split('.')[:-1])
+
+        if args.spool is not None:
+            submit(ssml, outfile, args.spool, args.profile, args.sample_rate)
+        else:
+            ssml2audio(ssml, outfile, args.profile, args.backend, args.hedge, scheduler, args.sample_rate,
+                       args.incremental)
+
+    if args.spool is not None or len(args.path) == 1:
+        scheduler = None
+        for path in args.path:
+            convert(path)
+    else:
+        import threading
+
+        scheduler = QuotaScheduler()
+        failed = []
+
+        def convert_thread(path):
+            try:
+                convert(path)
+            except BaseException:
+                logging.exception(f'converting {path} failed')
+                failed.append(path)
+
+        threads = [threading.Thread(target=convert_thread, args=(path,)) for path in args.path]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if len(failed) > 0:
+            logging.fatal(f'{len(failed)} of {len(args.path)} documents failed: {", ".join(failed)}')
+            exit(1)
+
+    try:
+        import resource
+
+        logging.info(f'peak memory {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB')
+    except ImportError:
+        pass
@@ -0,0 +1,87 @@
+"""
+Checks that memory used to convert a document does not grow with the size of the document.
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# peak memory of a conversion in KiB
+PEAK_MEMORY = 128 * 1024
+# allowed difference of peak memory between a small and a large document in KiB
+GROWTH = 16 * 1024
+
+SMALL = 2 * 1024 * 1024
+LARGE = 8 * 1024 * 1024
+
+# converts a markdown file like TTS File.py using the silence backend and prints peak memory,
+# the low sample rate keeps the audio small
+CONVERT = """
+import importlib.util
+import resource
+import sys
+
+spec = importlib.util.spec_from_file_location('tts_file', 'TTS File.py')
+tts_file = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(tts_file)
+
+from utils.md2ssml import sections2ssml
+from utils.ssml2audio import ssml2audio
+from utils.tts_preprocess import TTSPreprocessor
+
+preprocessor = TTSPreprocessor(full_names=False, autocorrect=False)
+ssml2audio(sections2ssml(tts_file.document_sections(sys.argv[1]), preprocessor), sys.argv[2], 'wav', 'silence',
+           sample_rate=1000)
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def write_document(path, size):
+    """
+    Writes a markdown document with chapters of distinct paragraphs.
+
+    :param path: path to the markdown file
+    :param size: int: minimal size in bytes
+    """
+    sentence = 'Byl to velký hrad na kopci nad řekou a žili v něm rytíři se svými koňmi. '
+    written = 0
+    chapter = 0
+    with open(path, 'w', encoding='UTF-8') as f:
+        while written < size:
+            chapter += 1
+            paragraphs = [f'Kapitola {chapter} a odstavec {num}. ' + sentence * 8 for num in range(20)]
+            text = f'# Kapitola {chapter}\n\n' + '\n\n'.join(paragraphs) + '\n\n'
+            f.write(text)
+            written += len(text.encode('UTF-8'))
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'ru_maxrss is in KiB on linux')
+class TestMemory(unittest.TestCase):
+    def peak_memory(self, size):
+        """
+        Converts a generated document in a new process.
+
+        :param size: int: size of the document in bytes
+        :return: int: peak memory in KiB
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'document.md')
+            write_document(path, size)
+            output = subprocess.run([sys.executable, '-c', CONVERT, path, os.path.join(tmp, 'document')],
+                                    cwd=ROOT, env=dict(os.environ, LC_ALL='C.UTF-8'), check=True,
+                                    stdout=subprocess.PIPE, encoding='UTF-8').stdout
+        return int(output.splitlines()[-1])
+
+    def test_peak_memory(self):
+        small = self.peak_memory(SMALL)
+        large = self.peak_memory(LARGE)
+
+        self.assertLess(large, PEAK_MEMORY)
+        self.assertLess(large - small, GROWTH)
+
+
+if __name__ == '__main__':
+    unittest.main()
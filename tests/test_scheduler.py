@@ -0,0 +1,75 @@
+"""
+Checks that documents converted at the same time through a QuotaScheduler stay within the TTS quota and that
+a short document is not stuck behind a long one.
+"""
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from google.api_core import exceptions
+
+from utils import ssml2audio
+from utils.scheduler import QuotaScheduler
+
+# quota per shortened minute, the documents need more than a minute of it
+CHARS_PER_MINUTE = 6000
+REQUESTS_PER_MINUTE = 10000
+MINUTE = 3.0
+
+# chunks are numbered, identical chunks are synthesized once
+CHUNK = '<speak>Věta {num}. ' + 'Krátká věta pro test kvóty. ' * 3 + '</speak>'
+LONG = 60
+SHORT = 6
+
+
+class CountingQuotaWindow(ssml2audio.QuotaWindow):
+    """
+    Quota window counting rejected requests, retries of the synthesizer would hide them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rejected = 0
+
+    def spend(self, chars):
+        try:
+            super().spend(chars)
+        except exceptions.TooManyRequests:
+            self.rejected += 1
+            raise
+
+
+class TestScheduler(unittest.TestCase):
+    def test_quota(self):
+        quota = CountingQuotaWindow(CHARS_PER_MINUTE, REQUESTS_PER_MINUTE, MINUTE)
+        scheduler = QuotaScheduler(CHARS_PER_MINUTE, REQUESTS_PER_MINUTE, minute=MINUTE)
+        self.assertGreater(len(CHUNK.format(num=0)) * (LONG + SHORT), CHARS_PER_MINUTE)
+
+        finished = {}
+
+        def convert(name, chunks, outfile):
+            ssml = '\n'.join(CHUNK.format(num=num) for num in range(chunks))
+            ssml2audio.ssml2audio(ssml, outfile, 'wav', 'limited', scheduler=scheduler,
+                                  sample_rate=1000)
+            finished[name] = time.monotonic()
+
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(ssml2audio, 'limited_quota', quota):
+            threads = [threading.Thread(target=convert, args=(name, chunks, os.path.join(tmp, name)))
+                       for name, chunks in [('long', LONG), ('short', SHORT)]]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertTrue(os.path.isfile(os.path.join(tmp, 'long.wav')))
+            self.assertTrue(os.path.isfile(os.path.join(tmp, 'short.wav')))
+
+        self.assertEqual(quota.rejected, 0)
+        self.assertLess(finished['short'], finished['long'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+Checks that several workers sharing a spool directory synthesize every chunk once and the document is assembled
+in order.
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+import wave
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+WORKERS = 3
+CHUNKS = 60
+
+# low sample rate keeps the audio small, the silence backend gives one millisecond per character
+SAMPLE_RATE = 1000
+
+
+def spool(path, *args):
+    """
+    Runs utils/spool.py.
+
+    :param path: path to the spool directory
+    :param args: str: command and its options
+    :return: subprocess.Popen
+    """
+    return subprocess.Popen([sys.executable, '-m', 'utils.spool', path, *args], cwd=ROOT, stdin=subprocess.PIPE,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding='UTF-8')
+
+
+class TestSpool(unittest.TestCase):
+    def run_spool(self, path, *args, stdin=None):
+        process = spool(path, *args)
+        _, err = process.communicate(stdin, timeout=120)
+        self.assertEqual(process.returncode, 0, err)
+
+    def test_workers(self):
+        # chunks of different lengths, so that a missing or duplicated chunk changes the length of the audio
+        chunks = [f'<speak>Věta číslo {num}.{" Další věta." * (num % 7)}</speak>' for num in range(CHUNKS)]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'spool')
+            outfile = os.path.join(tmp, 'document')
+            self.run_spool(path, 'submit', outfile, '--profile', 'wav', '--sample-rate', str(SAMPLE_RATE),
+                           stdin='\n'.join(chunks))
+
+            workers = [spool(path, 'worker', '--backend', 'silence', '--exit-when-idle') for _ in range(WORKERS)]
+            for process in workers:
+                _, err = process.communicate(timeout=120)
+                self.assertEqual(process.returncode, 0, err)
+
+            self.run_spool(path, 'assemble')
+
+            self.assertEqual(sorted(os.listdir(os.path.join(path, 'pending'))), [])
+            self.assertEqual(sorted(os.listdir(os.path.join(path, 'leased'))), [])
+            self.assertEqual(sorted(os.listdir(os.path.join(path, 'failed'))), [])
+            self.assertEqual(sorted(os.listdir(os.path.join(path, 'docs'))), [])
+            self.assertEqual(len(os.listdir(os.path.join(path, 'done'))), CHUNKS)
+
+            with wave.open(outfile + '.wav', 'rb') as f:
+                self.assertEqual(f.getframerate(), SAMPLE_RATE)
+                self.assertEqual(f.getnframes(), sum(SAMPLE_RATE * len(chunk) // 1000 for chunk in chunks))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+#! ./venv/bin/python3
+"""
+Expands abbreviations using an Aho-Corasick automaton, so the whole dictionary is matched in one pass.
+"""
+import re
+
+EXPANSIONS = "utils/abbreviation_data/expansions.txt"
+
+# text allowed before an abbreviation at the start of a sentence
+RE_SENTENCE_START = r"(\s|<[^>]*>|[(\[\"„“])*"
+# text allowed after an abbreviation at the end of a sentence
+RE_SENTENCE_END = r"(\s|<[^>]*>|[)\]\"“”])*"
+RE_NEXT_WORD = r"\s*(?:<[^>]*>\s*)*(\w+)"
+RE_PREVIOUS_WORD = r"([\w.]+)(?:\s|<[^>]*>)*$"
+RE_ORDINAL = r"(\d+|[IVXLCDM]+)\."
+# characters before an abbreviation searched for the previous word, keeps the search independent of text length
+PREVIOUS_WINDOW = 100
+
+# expansion leaving the abbreviation as it is, used where the right form cannot be decided
+KEEP = '-'
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton finding all occurrences of a set of patterns in linear time.
+    """
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]  # patterns ending in each state (including those reached by fail links)
+
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append(pattern)
+
+        # breadth first construction of fail links
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def finditer(self, text):
+        """
+        Finds all occurrences of the patterns.
+
+        :param text: str: text
+        :return: generator of (start, end, pattern)
+        """
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for pattern in self.output[state]:
+                yield end - len(pattern), end, pattern
+
+
+def load_expansions(path=EXPANSIONS):
+    """
+    Loads the expansion dictionary.
+
+    :param path: path to the dictionary file
+    :return: dict: abbreviation -> (default expansion, list of (previous word, name suffix, expansion) with
+        conditions on the name first, list of (suffix, expansion) sorted longest first)
+    """
+    expansions = {}
+    with open(path, 'r', encoding='UTF-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.strip() == '' or line.startswith('#'):
+                continue
+            abbreviation, default, *forms = line.split('\t')
+            forms = [tuple(form.split('=', 1)) for form in forms]
+            previous = [(*condition[1:].partition(' ')[::2], form) for condition, form in forms
+                        if condition.startswith('<')]
+            previous.sort(key=lambda form: len(form[1]), reverse=True)
+            suffixes = [(condition, form) for condition, form in forms if not condition.startswith('<')]
+            suffixes.sort(key=lambda form: len(form[0]), reverse=True)
+            expansions[abbreviation] = (default, previous, suffixes)
+    return expansions
+
+
+class AbbreviationExpander:
+    """
+    Replaces abbreviations in a sentence with their expansions. The form is chosen by the preceding word
+    (e.g. a preposition) together with the ending of the following name, by the preceding word alone or to agree
+    with the following name.
+    """
+
+    def __init__(self, expansions):
+        self.expansions = expansions
+        self.automaton = AhoCorasick({abbreviation.lower() for abbreviation in expansions})
+        self.lower = {}  # lowercase pattern -> abbreviations
+        for abbreviation in expansions:
+            self.lower.setdefault(abbreviation.lower(), []).append(abbreviation)
+
+    def _accept(self, text, start, end):
+        """
+        Checks word boundaries and case of a match.
+
+        :return: str: matched abbreviation or None
+        """
+        if start > 0 and text[start - 1].isalnum():
+            return None
+        if end < len(text) and text[end - 1].isalnum() and text[end].isalnum():
+            return None
+
+        matched = text[start:end]
+        for abbreviation in self.lower[matched.lower()]:
+            if matched == abbreviation:
+                return abbreviation
+            if abbreviation.islower() and matched == abbreviation[0].upper() + abbreviation[1:] and \
+                    re.fullmatch(RE_SENTENCE_START, text[:start]):
+                # a capital letter followed by a name is an initial (R. Novák), not r. or č.
+                if len(abbreviation.rstrip('.')) == 1 and self._next_name(text, end) is not None:
+                    continue
+                return abbreviation
+        return None
+
+    @staticmethod
+    def _next_name(text, end):
+        """
+        Finds the last word of a name (capitalized words) following an abbreviation, e.g. the surname.
+
+        :return: str: word or None if the following word is not capitalized
+        """
+        name = None
+        word = re.compile(RE_NEXT_WORD).match(text, end)
+        while word is not None and word.group(1)[0].isupper():
+            name = word.group(1)
+            word = re.compile(RE_NEXT_WORD).match(text, word.end())
+        return name
+
+    def _expand(self, text, abbreviation, start, end):
+        default, previous_forms, suffix_forms = self.expansions[abbreviation]
+        expansion = None
+
+        name = ''
+        if len(previous_forms) > 0 or len(suffix_forms) > 0:
+            name = (self._next_name(text, end) or '').lower()
+
+        previous = None
+        if len(previous_forms) > 0:
+            previous = re.search(RE_PREVIOUS_WORD, text[max(0, start - PREVIOUS_WINDOW):start])
+        if previous is not None:
+            # a preposition may govern several cases, the ending of the name decides between them
+            for condition, suffix, form in previous_forms:
+                if (condition == previous.group(1).lower() or
+                    (condition == '#.' and re.fullmatch(RE_ORDINAL, previous.group(1)))) and \
+                        (suffix == '' or name.endswith(suffix)):
+                    expansion = form
+                    break
+
+        if expansion is None and name != '':
+            for suffix, form in suffix_forms:
+                if name.endswith(suffix):
+                    expansion = form
+                    break
+
+        if expansion is None:
+            expansion = default
+        if expansion == KEEP:
+            return text[start:end]
+
+        if text[start].isupper() and re.fullmatch(RE_SENTENCE_START, text[:start]):
+            expansion = expansion[0].upper() + expansion[1:]
+        if abbreviation.endswith('.') and re.compile(RE_SENTENCE_END).fullmatch(text, end):
+            expansion += '.'  # the period of the abbreviation also ends the sentence
+        return expansion
+
+    def expand(self, text):
+        """
+        Expands all abbreviations in a sentence. Overlapping matches are resolved leftmost longest.
+
+        :param text: str: sentence
+        :return: str: text with expanded abbreviations
+        """
+        lowered = ''.join(char.lower() if len(char.lower()) == 1 else char for char in text)
+
+        matches = []
+        for start, end, _ in self.automaton.finditer(lowered):
+            abbreviation = self._accept(text, start, end)
+            if abbreviation is not None:
+                matches.append((start, -end, abbreviation))
+        matches.sort()
+
+        out = []
+        position = 0
+        for start, end, abbreviation in matches:
+            end = -end
+            if start < position:
+                continue
+            out.append(text[position:start])
+            out.append(self._expand(text, abbreviation, start, end))
+            position = end
+        out.append(text[position:])
+        return ''.join(out)
+
+
+if __name__ == '__main__':
+    import argparse
+    import random
+    import sys
+    import time
+
+    args = argparse.ArgumentParser(description='Expands abbreviations in text from stdin.')
+    args.add_argument('--benchmark', action='store_true',
+                      help='compare the cost of the automaton and one regex per abbreviation for growing '
+                           'dictionaries')
+    args = args.parse_args()
+
+    if not args.benchmark:
+        expander = AbbreviationExpander(load_expansions())
+        for line in sys.stdin:
+            print(expander.expand(line), end='')
+        sys.exit(0)
+
+    random.seed(0)
+    letters = 'abcdefghijklmnopqrstuvwxyzáčďéěíňóřšťúůýž'
+    sentence = 'Byl to tzv. velký hrad, např. podle prof. Nováka a Ing. Dvořáka, viz str. 12 atd. ' * 20
+
+    print(f'{"entries":>8} {"automaton ms":>14} {"regex ms":>10}')
+    for size in [100, 1000, 10000]:
+        expansions = load_expansions()
+        while len(expansions) < size:
+            word = ''.join(random.choice(letters) for _ in range(random.randint(2, 6))) + '.'
+            expansions[word] = ('x', [], [])
+
+        expander = AbbreviationExpander(expansions)
+        start = time.perf_counter()
+        for _ in range(10):
+            expander.expand(sentence)
+        automaton = (time.perf_counter() - start) / 10 * 1000
+
+        regexes = [re.compile(r'(?<!\w)' + re.escape(abbreviation)) for abbreviation in expansions]
+        start = time.perf_counter()
+        text = sentence
+        for regex in regexes:
+            text = regex.sub(lambda match: expansions[match.group()][0], text)
+        regex_time = (time.perf_counter() - start) * 1000
+
+        print(f'{size:>8} {automaton:>14.2f} {regex_time:>10.2f}')
@@ -2,12 +2,26 @@
 """
 Converts most files to markdown.
 """
+import locale
 import logging
+import mmap
 import os
+import re
 import tempfile
 
 tmpdir = tempfile.TemporaryDirectory()
 
+# sections without headings are split at the first blank line after this many bytes
+MAX_SECTION = 1 << 20
+
+RE_HEADING = rb'#{1,6} '
+
+# extensions read by sections directly from the file
+MAPPABLE = ["md", "markdown", "txt"]
+
+# encoding tried for text invalid in the locale encoding, common for older czech text files
+FALLBACK_ENCODING = 'cp1250'
+
 
 def pdf2md(file):
     """
@@ -69,8 +83,6 @@ def file2md(path):
         with open(path, 'r') as f:
             return f.read()
     elif ext == "pdf":
-        import re
-
         logging.info("parsing pdf using @opendocsg/pdf2md")
         md = pdf2md(path)
 
@@ -113,6 +125,81 @@ def file2md(path):
             return f.read()
 
 
+def decode(data, encoding):
+    """
+    Decodes text. Text invalid in the encoding is decoded as FALLBACK_ENCODING, remaining invalid characters
+    are replaced instead of failing.
+
+    :param data: bytes: encoded text
+    :param encoding: str: encoding
+    :return: str: text
+    """
+    try:
+        return data.decode(encoding)
+    except UnicodeDecodeError as e:
+        logging.warning(f'text is not valid {encoding} ({e}), decoding as {FALLBACK_ENCODING}')
+    return data.decode(FALLBACK_ENCODING, errors='replace')
+
+
+def split_sections(lines, encoding='UTF-8'):
+    """
+    Splits markdown lines into sections starting with a heading. Long sections are split at blank lines
+    (or at any line if there is no blank line) so that a section stays around MAX_SECTION bytes.
+
+    :param lines: iterable of bytes: markdown lines including line endings
+    :param encoding: str: encoding of the lines
+    :return: generator of str: markdown sections
+    """
+    section = []
+    size = 0
+    for line in lines:
+        if size > 0 and (re.match(RE_HEADING, line) or
+                         (size >= MAX_SECTION and line.strip() == b'') or size >= 4 * MAX_SECTION):
+            yield decode(b''.join(section), encoding)
+            section = []
+            size = 0
+        section.append(line)
+        size += len(line)
+    if size > 0:
+        yield decode(b''.join(section), encoding)
+
+
+def text_sections(md):
+    """
+    Splits a markdown string into sections.
+
+    :param md: str: markdown
+    :return: generator of str: markdown sections
+    """
+    return split_sections(line.encode('UTF-8') for line in md.splitlines(keepends=True))
+
+
+def file_sections(path):
+    """
+    Converts most files to markdown one section at a time. Markdown and plain text files are memory-mapped,
+    so only the current section is held in memory. They are read in the locale encoding like in file2md.
+
+    :param path: path to input file
+    :return: generator of str: markdown sections
+    """
+    ext = path.split(".")[-1].lower()
+
+    if ext in MAPPABLE and os.path.isfile(path) and os.path.getsize(path) > 0:
+        logging.info("reading markdown by sections")
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            released = 0
+            for section in split_sections(iter(mm.readline, b''), locale.getpreferredencoding(False)):
+                yield section
+
+                # pages already read would otherwise stay resident and count towards memory usage
+                position = mm.tell() - mm.tell() % mmap.PAGESIZE
+                if hasattr(mmap, 'MADV_DONTNEED') and position > released:
+                    mm.madvise(mmap.MADV_DONTNEED, released, position - released)
+                    released = position
+    else:
+        yield from text_sections(file2md(path))
+
+
 if __name__ == '__main__':
     import argparse
 
@@ -0,0 +1,160 @@
+#! ./venv/bin/python3
+"""
+Removes running headers, footers and page numbers from markdown converted from pdf.
+
+A line is boilerplate if it is short and repeats periodically through the document, about once per page.
+Lines repeated close to each other or at irregular distances (dialogue, list items) are kept.
+"""
+import hashlib
+import logging
+import re
+
+import utils.roman_num as roman
+
+# lines repeated at least this many times are considered boilerplate
+MIN_COUNT = 8
+
+# longer lines are never considered boilerplate, typical length of a running header or footer
+MAX_LENGTH = 80
+
+# minimal distance in characters between repeats of a boilerplate line, about a page
+MIN_PERIOD = 500
+
+# allowed deviation of a distance between repeats from a multiple of the typical distance (a fraction of it)
+TOLERANCE = 0.4
+
+# fraction of distances between repeats which must fit, pages of irregular length (chapter ends, figures)
+# may break the period
+MIN_FIT = 0.9
+
+# distances between repeats kept per line
+MAX_GAPS = 64
+
+# lossy counting bucket width, lines repeating less often than once per BUCKET lines may not be counted
+BUCKET = 20000
+
+
+def _normalize(line):
+    """
+    Normalizes a line so that running headers with varying page numbers hash the same.
+
+    :param line: str: line of markdown
+    :return: str: normalized line
+    """
+    line = line.strip().lower()
+    if re.match(roman.RE_VALIDATE, line.upper()):
+        return '#'  # roman page numbers
+    line = re.sub(r'^\d+|\d+$', '#', line)  # page numbers at the start or end of the line
+    line = re.sub(r'\s+', ' ', line)
+    return line
+
+
+def _is_candidate(line, max_length):
+    """
+    Checks if a line can be boilerplate. Headings are kept, numbered chapter titles look like running headers.
+
+    :param line: str: line of markdown
+    :param max_length: int: maximal length of a boilerplate line
+    :return: bool
+    """
+    return line.strip() != '' and len(line.strip()) <= max_length and not line.lstrip().startswith('#')
+
+
+def _line_hash(line):
+    """
+    Hashes a normalized line.
+
+    :param line: str: line of markdown
+    :return: bytes: digest
+    """
+    return hashlib.blake2b(_normalize(line).encode('UTF-8'), digest_size=8).digest()
+
+
+def _is_periodic(gaps, min_count=MIN_COUNT):
+    """
+    Checks if repeats of a line are spread through the document like page headers. Most distances between
+    repeats must be close to a multiple of the typical distance, pages without the header are allowed.
+
+    :param gaps: list of int: distances in characters between consecutive repeats
+    :param min_count: int: minimal number of occurrences of a boilerplate line
+    :return: bool
+    """
+    if len(gaps) < min_count - 1:
+        return False
+    period = sorted(gaps)[len(gaps) // 2]
+    if period < MIN_PERIOD:
+        return False
+    fit = sum(abs(gap - max(1, round(gap / period)) * period) <= TOLERANCE * period for gap in gaps)
+    return fit >= MIN_FIT * len(gaps)
+
+
+def find_boilerplate(md, min_count=MIN_COUNT, max_length=MAX_LENGTH, bucket=BUCKET):
+    """
+    Finds lines repeating periodically through the document. Lines are counted using lossy counting, so
+    memory does not grow with the document. Counts are exact for documents with fewer than bucket candidate
+    lines, for longer documents lines repeating less often than once per bucket lines may be missed.
+
+    :param md: str: markdown
+    :param min_count: int: minimal number of occurrences of a boilerplate line
+    :param max_length: int: maximal length of a boilerplate line
+    :param bucket: int: width of a lossy counting bucket
+    :return: set of line hashes
+    """
+    lines = {}  # line hash -> [count, maximal undercount, offset of the last repeat, distances between repeats]
+    n = 0
+    offset = 0
+    for line in md.splitlines(keepends=True):
+        offset += len(line)
+        if not _is_candidate(line, max_length):
+            continue
+        n += 1
+        current = (n - 1) // bucket + 1
+
+        digest = _line_hash(line)
+        if digest in lines:
+            entry = lines[digest]
+            entry[0] += 1
+            if len(entry[3]) < MAX_GAPS:
+                entry[3].append(offset - entry[2])
+            entry[2] = offset
+        else:
+            lines[digest] = [1, current - 1, offset, []]
+
+        if n % bucket == 0:
+            lines = {digest: entry for digest, entry in lines.items() if entry[0] + entry[1] > current}
+
+    return {digest for digest, (count, _, _, gaps) in lines.items()
+            if count >= min_count and _is_periodic(gaps, min_count)}
+
+
+def remove_boilerplate(md, min_count=MIN_COUNT, max_length=MAX_LENGTH):
+    """
+    Drops lines that repeat periodically through the document, like headers and footers of every page.
+
+    :param md: str: input markdown
+    :param min_count: int: minimal number of occurrences of a boilerplate line
+    :param max_length: int: maximal length of a boilerplate line
+    :return: str: markdown without boilerplate
+    """
+    boilerplate = find_boilerplate(md, min_count, max_length)
+
+    out = []
+    removed = 0
+    for line in md.splitlines(keepends=True):
+        if _is_candidate(line, max_length) and _line_hash(line) in boilerplate:
+            removed += len(line)
+            logging.debug(f'removing boilerplate line {line.strip()}')
+        else:
+            out.append(line)
+
+    logging.info(f'boilerplate removal saved {removed} characters ({removed / max(len(md), 1):.1%})')
+
+    return ''.join(out)
+
+
+if __name__ == '__main__':
+    import sys
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    print(remove_boilerplate(sys.stdin.read()))
@@ -2,13 +2,16 @@
 """
 Converts markdown to speech synthesis markup language.
 """
+import logging
 import re
+import zlib
 from abc import ABC
 from html.parser import HTMLParser
 
 from markdown import markdown
 
 import utils.separator as separator
+from utils.ssml_compact import compact_ssml, compact_line
 from utils.tts_preprocess import TTSPreprocessor
 
 RE_ITALICS = r"\*([^*]+)\*"
@@ -17,6 +20,13 @@ RE_BRACKETS = r"[[({]([[\](){}]+)[\])}]"
 
 ALLOWED_TAGS = ['em', 'strong', 'p', 'b', 'i']
 
+# chunk size limits in utf-8 bytes of the rendered <p><s>...</s></p> markup, google cloud text to speech
+# accepts at most 5000 bytes per request, czech letters with diacritics take two bytes
+CHUNK_MAX = 5000
+CHUNK_MIN = 500
+# a chunk ends after a sentence whose hash is divisible by CHUNK_SENTENCES
+CHUNK_SENTENCES = 16
+
 
 class FilterHtmlTags(HTMLParser, ABC):
     """
@@ -66,46 +76,58 @@ class FilterHtmlTags(HTMLParser, ABC):
         :param data: str: html to filter
         :return: str: filtered html
         """
+        self.out = ''
         super().feed(data)
         return re.sub(r' +', ' ', self.out)  # remove duplicate spaces
 
 
-html_filter = FilterHtmlTags(ALLOWED_TAGS)
 preprocessor = TTSPreprocessor()
 
 
-def paragraph_ssml_process(match):
+def paragraph_ssml_process(match, sentence_preprocessor=preprocessor):
     """
     Converts markdown to ssml in one paragraph.
 
     :param match: regex match where group 1 is the paragraph content
+    :param sentence_preprocessor: TTSPreprocessor used on each sentence
     :return: str: ssml
     """
     text = match.group(1)
     sentences = separator.separate(text)  # separate text into sentences
     sentences = filter(lambda x: len(x.strip()) > 0, sentences)
-    sentences = map(preprocessor.preprocess_sentence, sentences)
+    sentences = map(sentence_preprocessor.preprocess_sentence, sentences)
 
-    # enforce google cloud text to speech 5000 character limit
+    # enforce google cloud text to speech 5000 byte limit
+    # chunk boundaries are content defined (depend on the sentence only) so that an edit
+    # changes only the chunks around it and the rest can be reused from the previous synthesis
     paragraphs = []
     paragraph = []
+    size = len('<p></p>')
     for sent in sentences:
+        sent_size = len(f'<s>{sent}</s>'.encode('UTF-8'))
+        if len(paragraph) > 0 and size + sent_size > CHUNK_MAX:
+            paragraphs.append(paragraph)
+            paragraph = []
+            size = len('<p></p>')
         paragraph.append(sent)
-        a = sum(map(len, paragraph))
-        if a > 4000:  # leave some space for control tags (<p><s><emphasis>...)
-            paragraph = paragraph[0:-1]
+        size += sent_size
+        if size >= CHUNK_MIN and zlib.crc32(sent.encode('UTF-8')) % CHUNK_SENTENCES == 0:
             paragraphs.append(paragraph)
-            paragraph = [sent]
-    paragraphs.append(paragraph)
+            paragraph = []
+            size = len('<p></p>')
+    if len(paragraph) > 0:
+        paragraphs.append(paragraph)
 
     return "\n".join(map(lambda paragraph_sent: f"<p><s>{'</s><s>'.join(paragraph_sent)}</s></p>", paragraphs))
 
 
-def md2ssml(md):
+def md2ssml(md, sentence_preprocessor=preprocessor, compact=True):
     """
     Converts a markdown string to a ssml string.
 
     :param md: str input markdown
+    :param sentence_preprocessor: TTSPreprocessor used on each sentence
+    :param compact: bool: remove markup with no audible effect
     :return: str output ssml
     """
 
@@ -138,7 +160,7 @@ def md2ssml(md):
     html = markdown(md)
 
     # remove any unused tags
-    out = html_filter.process(html)
+    out = FilterHtmlTags(ALLOWED_TAGS).process(html)
 
     # emphasize italics
     out = out.replace("<em>", "<emphasis>")
@@ -163,11 +185,38 @@ def md2ssml(md):
 
     # process paragraph
     paragraph_regex = r"<p>(.*?)</p>"  # using non-greedy operator (?)
-    out = re.sub(paragraph_regex, paragraph_ssml_process, out)
+    out = re.sub(paragraph_regex, lambda match: paragraph_ssml_process(match, sentence_preprocessor), out)
+
+    # remove markup with no audible effect
+    if compact:
+        out = compact_ssml(out)
 
     return out
 
 
+def sections2ssml(sections, sentence_preprocessor=preprocessor, compact=True):
+    """
+    Converts markdown sections to ssml one section at a time.
+
+    :param sections: iterable of str: markdown sections starting with a heading
+    :param sentence_preprocessor: TTSPreprocessor used on each sentence
+    :param compact: bool: remove markup with no audible effect
+    :return: generator of str: ssml of each section
+    """
+    before = 0
+    after = 0
+    for section in sections:
+        out = md2ssml(section, sentence_preprocessor, compact=False)
+        if compact:
+            before += len(out.encode('UTF-8'))
+            out = '\n'.join(filter(lambda line: line != '', map(compact_line, out.splitlines())))
+            after += len(out.encode('UTF-8'))
+        yield out
+
+    if compact:
+        logging.info(f'ssml compaction saved {before - after} bytes ({(before - after) / max(before, 1):.1%})')
+
+
 if __name__ == '__main__':
     import sys
 
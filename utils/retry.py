@@ -0,0 +1,145 @@
+#! ./venv/bin/python3
+"""
+Per-request deadlines, retries and hedged requests for synthesis backends.
+"""
+import concurrent.futures
+import logging
+import math
+import random
+import time
+
+# requests needed before deadlines and hedging are based on observed latency
+MIN_SAMPLES = 5
+
+
+def percentile(values, p):
+    """
+    Computes a percentile using the nearest rank method.
+
+    :param values: list of numbers
+    :param p: float: percentile between 0 and 100
+    :return: float: percentile or None if values are empty
+    """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+
+class ReliableSynthesizer:
+    """
+    Wraps a synthesis backend with adaptive deadlines, retries with jittered backoff and optional hedging.
+
+    The backend is a function taking a ssml chunk and a timeout in seconds and returning audio bytes.
+    The deadline of a request is the 99th percentile of observed latency per character times the request
+    length times deadline_factor, limited to min_deadline and max_deadline. With hedging a duplicate
+    request is sent when the first one exceeds the 95th percentile latency and the first answer is used.
+    If acquire is given, it is called with the request length in the calling thread before every request sent
+    (including retries and hedged duplicates) and may block, e.g. to wait for quota. The wait is not counted
+    as latency and the deadline starts when it ends.
+    """
+
+    def __init__(self, synthesize, retryable=(TimeoutError, ConnectionError), retries=4, hedge=False,
+                 min_deadline=30.0, max_deadline=300.0, deadline_factor=3.0, backoff=1.0, acquire=None):
+        self.synthesize = synthesize
+        self.acquire = acquire
+        self.retryable = retryable + (concurrent.futures.TimeoutError,)
+        self.retries = retries
+        self.hedge = hedge
+        self.min_deadline = min_deadline
+        self.max_deadline = max_deadline
+        self.deadline_factor = deadline_factor
+        self.backoff = backoff
+
+        self.latencies = []  # seconds per successful request
+        self.rates = []  # seconds per character of successful requests
+        self.retried = 0
+        self.hedged = 0
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=4) if hedge else None
+
+    def deadline(self, chars):
+        """
+        Computes the deadline of a request.
+
+        :param chars: int: length of the request
+        :return: float: seconds
+        """
+        if len(self.rates) < MIN_SAMPLES:
+            return self.max_deadline
+        deadline = percentile(self.rates, 99) * chars * self.deadline_factor
+        return min(self.max_deadline, max(self.min_deadline, deadline))
+
+    def _acquire(self, ssml_line):
+        if self.acquire is not None:
+            self.acquire(len(ssml_line))
+
+    def _timed(self, ssml_line, timeout):
+        start = time.monotonic()
+        audio = self.synthesize(ssml_line, timeout)
+        return audio, time.monotonic() - start
+
+    def _attempt(self, ssml_line):
+        deadline = self.deadline(len(ssml_line))
+        self._acquire(ssml_line)
+
+        if not self.hedge or len(self.rates) < MIN_SAMPLES:
+            return self._timed(ssml_line, deadline)
+
+        hedge_delay = percentile(self.rates, 95) * len(ssml_line)
+        start = time.monotonic()
+        futures = {self.executor.submit(self._timed, ssml_line, deadline)}
+        done, _ = concurrent.futures.wait(futures, timeout=hedge_delay)
+
+        if len(done) == 0:
+            self._acquire(ssml_line)
+            # the first request may have finished while waiting for quota
+            if not any(future.done() for future in futures):
+                self.hedged += 1
+                logging.info(f'hedging request after {hedge_delay:.1f} s')
+                futures.add(self.executor.submit(self._timed, ssml_line, deadline - (time.monotonic() - start)))
+
+        error = None
+        while len(futures) > 0:
+            remaining = deadline - (time.monotonic() - start)
+            done, futures = concurrent.futures.wait(futures, timeout=max(remaining, 0),
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            if len(done) == 0:
+                raise concurrent.futures.TimeoutError(f'deadline of {deadline:.1f} s exceeded')
+            for future in done:
+                if future.exception() is None:
+                    return future.result()[0], time.monotonic() - start
+                error = future.exception()
+        raise error
+
+    def __call__(self, ssml_line):
+        """
+        Synthesizes a ssml chunk.
+
+        :param ssml_line: str: ssml chunk
+        :return: bytes: audio
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                audio, latency = self._attempt(ssml_line)
+            except self.retryable as e:
+                if attempt == self.retries:
+                    raise
+                self.retried += 1
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                logging.warning(f'request failed ({type(e).__name__}: {e}), retrying in {delay:.1f} s')
+                time.sleep(delay)
+                continue
+
+            self.latencies.append(latency)
+            self.rates.append(latency / max(len(ssml_line), 1))
+            return audio
+
+    def report(self):
+        """
+        Logs latency percentiles of the run.
+        """
+        if len(self.latencies) == 0:
+            return
+        logging.info(f'{len(self.latencies)} requests, {self.retried} retries, {self.hedged} hedged, latency '
+                     + ', '.join(f'p{p} {percentile(self.latencies, p):.2f} s' for p in [50, 90, 95, 99]))
@@ -0,0 +1,119 @@
+#! ./venv/bin/python3
+"""
+Shares the TTS quota between documents converted at the same time.
+
+Requests wait for tokens in two buckets (characters and requests per minute) and are served in weighted
+fair queuing order (self-clocked), so every document gets its share of the characters and short documents
+are not stuck behind long ones.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+# google cloud text to speech quota, adjust to the quota of the project
+CHARS_PER_MINUTE = 150000
+REQUESTS_PER_MINUTE = 300
+
+# fraction of the quota used, stays below it to avoid quota errors
+HEADROOM = 0.95
+
+# the buckets hold at most this many seconds of quota, a full bucket and a minute of refill must stay
+# below the per-minute quota (HEADROOM * (60 + BURST) / 60 < 1)
+BURST = 2
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a fixed rate.
+    """
+
+    def __init__(self, per_minute, capacity, minute=60.0):
+        self.rate = per_minute / minute
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_time(self, amount):
+        """
+        Computes how long to wait until amount tokens are available.
+
+        :param amount: float: tokens
+        :return: float: seconds
+        """
+        self._refill()
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def take(self, amount):
+        """
+        Removes tokens from the bucket. Requests larger than the capacity wait for a full bucket and leave it in
+        debt, so the rate is kept for them too.
+
+        :param amount: float: tokens
+        """
+        self._refill()
+        self.tokens -= amount
+
+
+class QuotaScheduler:
+    """
+    Thread-safe scheduler of requests from several jobs sharing one quota, using the headroom fraction of it.
+    A minute lasts minute seconds, tests shorten it so that the quota runs out quickly.
+    """
+
+    def __init__(self, chars_per_minute=CHARS_PER_MINUTE, requests_per_minute=REQUESTS_PER_MINUTE,
+                 headroom=HEADROOM, minute=60.0):
+        chars_per_minute *= headroom
+        requests_per_minute *= headroom
+        # no minimal capacity, a bucket larger than the quota would let a burst exceed it
+        self.chars = TokenBucket(chars_per_minute, chars_per_minute / 60 * BURST, minute)
+        self.requests = TokenBucket(requests_per_minute, max(requests_per_minute / 60 * BURST, 1), minute)
+
+        self.condition = threading.Condition()
+        self.queue = []  # heap of (finish tag, sequence number)
+        self.counter = itertools.count()
+        self.virtual_time = 0.0
+        self.finish = {}  # last finish tag of each job
+
+    def acquire(self, job, chars, weight=1.0):
+        """
+        Blocks until a request of the job may be sent.
+
+        :param job: hashable identifier of the job (e.g. output path)
+        :param chars: int: length of the request
+        :param weight: float: share of the quota relative to other jobs
+        """
+        with self.condition:
+            tag = max(self.virtual_time, self.finish.get(job, 0.0)) + chars / weight
+            self.finish[job] = tag
+            entry = (tag, next(self.counter))
+            heapq.heappush(self.queue, entry)
+            self.condition.notify_all()
+
+            while True:
+                if self.queue[0] == entry:
+                    wait = max(self.chars.wait_time(chars), self.requests.wait_time(1))
+                    if wait == 0:
+                        heapq.heappop(self.queue)
+                        self.chars.take(chars)
+                        self.requests.take(1)
+                        self.virtual_time = tag
+                        self.condition.notify_all()
+                        return
+                    self.condition.wait(wait)
+                else:
+                    self.condition.wait()
+
+    def release(self, job):
+        """
+        Forgets a finished job.
+
+        :param job: identifier of the job
+        """
+        with self.condition:
+            self.finish.pop(job, None)
@@ -0,0 +1,295 @@
+#! ./venv/bin/python3
+"""
+Work queue for synthesizing documents on several machines through a shared spool directory.
+
+Spool layout:
+    docs/<id>.json      - submitted document: output path, profile, sample rate and ordered chunk hashes
+    pending/<hash>.json - chunk waiting for a worker
+    leased/<hash>.json  - chunk claimed by a worker, its mtime is the last renewal of the lease
+    done/<hash>.<ext>   - synthesized chunk
+    failed/<hash>.json  - chunk which failed MAX_ATTEMPTS times, with the last error
+
+A chunk is claimed by atomically renaming it from pending to leased. The worker renews the lease while
+synthesizing, leases not renewed within the lease timeout are returned to pending, so chunks of a crashed
+worker are picked up by another one. Chunks are identified by their content, so identical chunks of
+different documents are synthesized once.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from utils.retry import ReliableSynthesizer
+from utils.ssml2audio import PROFILES, BACKENDS, RETRYABLE, chunk_hash, split_chunks, concatenate
+
+# seconds without renewal after which a claimed chunk is given to another worker,
+# leases are renewed every third of it
+LEASE = 600
+
+# claims of a chunk after which it is moved to failed
+MAX_ATTEMPTS = 3
+
+
+def _dirs(spool):
+    """
+    Creates the spool directory structure.
+
+    :param spool: path to the spool directory
+    :return: tuple of paths to docs, pending, leased, done and failed directories
+    """
+    dirs = tuple(os.path.join(spool, name) for name in ['docs', 'pending', 'leased', 'done', 'failed'])
+    for path in dirs:
+        os.makedirs(path, exist_ok=True)
+    return dirs
+
+
+def _write_atomic(path, data, mode='w'):
+    """
+    Writes a file so that other processes never see it partially written.
+
+    :param path: path to the file
+    :param data: str or bytes: content
+    :param mode: str: 'w' or 'wb'
+    """
+    # process ids collide between machines sharing the spool, mkstemp would create files unreadable to workers
+    # running as other users
+    part = f'{path}.{uuid.uuid4().hex}.part'
+    try:
+        with open(part, mode) as f:
+            f.write(data)
+        os.replace(part, path)
+    except BaseException:
+        if os.path.isfile(part):
+            os.remove(part)
+        raise
+
+
+def submit(ssml_text, outfile, spool, profile='mp3', sample_rate=None):
+    """
+    Splits a document into chunk jobs and adds them to the spool.
+
+    :param ssml_text: str: speech synthesis markup language file or an iterable of its sections
+    :param outfile: str: path to output audio without extension
+    :param spool: path to the spool directory
+    :param profile: str: audio encoding profile, one of PROFILES
+    :param sample_rate: int: sample rate in Hz, None for the default of the profile
+    """
+    docs, pending, leased, done, failed = _dirs(spool)
+    ext = PROFILES[profile]['ext']
+
+    if isinstance(ssml_text, str):
+        ssml_text = [ssml_text]
+
+    hashes = []
+    queued = 0
+    for ssml_line in (line for section in ssml_text for line in split_chunks(section)):
+        digest = chunk_hash(ssml_line, profile, sample_rate)
+        hashes.append(digest)
+        if os.path.isfile(os.path.join(done, f'{digest}.{ext}')) or \
+                os.path.isfile(os.path.join(leased, f'{digest}.json')):
+            continue
+        job = {'ssml': ssml_line, 'profile': profile, 'sample_rate': sample_rate}
+        _write_atomic(os.path.join(pending, f'{digest}.json'), json.dumps(job))
+        if os.path.isfile(os.path.join(failed, f'{digest}.json')):
+            os.remove(os.path.join(failed, f'{digest}.json'))  # resubmitted, try again
+        queued += 1
+
+    doc_id = hashlib.sha256(os.path.realpath(outfile).encode('UTF-8')).hexdigest()[:16]
+    _write_atomic(os.path.join(docs, f'{doc_id}.json'),
+                  json.dumps({'outfile': os.path.realpath(outfile), 'profile': profile, 'chunks': hashes}))
+
+    logging.info(f'submitted {outfile}: {queued} of {len(hashes)} chunks queued')
+
+
+def requeue_expired(spool, lease=LEASE):
+    """
+    Returns chunks with an expired lease to pending.
+
+    :param spool: path to the spool directory
+    :param lease: seconds after which a lease expires
+    """
+    docs, pending, leased, done, failed = _dirs(spool)
+    now = time.time()
+    for name in os.listdir(leased):
+        path = os.path.join(leased, name)
+        try:
+            if now - os.path.getmtime(path) > lease:
+                os.rename(path, os.path.join(pending, name))
+                logging.warning(f'lease of {name} expired, requeued')
+        except FileNotFoundError:
+            pass  # finished or requeued by another process
+
+
+def claim(spool):
+    """
+    Claims a pending chunk.
+
+    :param spool: path to the spool directory
+    :return: str: chunk hash or None if nothing is pending
+    """
+    docs, pending, leased, done, failed = _dirs(spool)
+    for name in sorted(os.listdir(pending)):
+        if not name.endswith('.json'):
+            continue
+        try:
+            # refresh mtime first, the rename keeps it and it marks the start of the lease
+            os.utime(os.path.join(pending, name))
+            os.rename(os.path.join(pending, name), os.path.join(leased, name))
+        except FileNotFoundError:
+            continue  # claimed by another worker
+        return name[:-len('.json')]
+    return None
+
+
+def _renew(path, lease, stop):
+    """
+    Renews a lease until stopped.
+
+    :param path: path to the leased chunk
+    :param lease: seconds after which a lease expires
+    :param stop: threading.Event: set when the chunk is finished
+    """
+    while not stop.wait(lease / 3):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return
+
+
+def worker(spool, backend='google', lease=LEASE, poll=5.0, exit_when_idle=False, hedge=False):
+    """
+    Synthesizes pending chunks until stopped.
+
+    :param spool: path to the spool directory
+    :param backend: str: synthesis backend, one of BACKENDS
+    :param lease: seconds after which a lease expires
+    :param poll: seconds to wait when there is no pending chunk
+    :param exit_when_idle: bool: return when there is no pending or leased chunk
+    :param hedge: bool: send a duplicate request when a request is slower than usual
+    """
+    docs, pending, leased, done, failed = _dirs(spool)
+    synthesizers = {}
+
+    while True:
+        requeue_expired(spool, lease)
+        digest = claim(spool)
+
+        if digest is None:
+            if exit_when_idle and len(os.listdir(leased)) == 0:
+                for synthesize in synthesizers.values():
+                    synthesize.report()
+                return
+            time.sleep(poll)
+            continue
+
+        job_path = os.path.join(leased, f'{digest}.json')
+        try:
+            with open(job_path, 'r', encoding='UTF-8') as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            continue  # lease expired and the chunk was claimed by another worker
+
+        # claims are counted, so a chunk crashing its workers is not retried forever
+        job['attempts'] = job.get('attempts', 0) + 1
+        if job['attempts'] > MAX_ATTEMPTS:
+            os.replace(job_path, os.path.join(failed, f'{digest}.json'))
+            logging.error(f"chunk {digest} failed {MAX_ATTEMPTS} times ({job.get('error')}), moved to failed")
+            continue
+        _write_atomic(job_path, json.dumps(job))
+
+        out_path = os.path.join(done, f"{digest}.{PROFILES[job['profile']]['ext']}")
+        if not os.path.isfile(out_path):
+            stop = threading.Event()
+            threading.Thread(target=_renew, args=(job_path, lease, stop), daemon=True).start()
+            try:
+                settings = (job['profile'], job.get('sample_rate'))
+                if settings not in synthesizers:
+                    synthesizers[settings] = ReliableSynthesizer(BACKENDS[backend](*settings), RETRYABLE,
+                                                                 hedge=hedge)
+                _write_atomic(out_path, synthesizers[settings](job['ssml']), 'wb')
+                logging.info(f'Audio content written to file {out_path}')
+            except Exception as e:
+                job['error'] = f'{type(e).__name__}: {e}'
+                logging.error(f"chunk {digest} failed ({job['error']}), attempt {job['attempts']} of {MAX_ATTEMPTS}")
+                try:
+                    _write_atomic(job_path, json.dumps(job))
+                    os.rename(job_path, os.path.join(pending, f'{digest}.json'))
+                except FileNotFoundError:
+                    pass  # lease expired and the chunk was claimed by another worker
+                continue
+            finally:
+                stop.set()
+
+        try:
+            os.remove(job_path)
+        except FileNotFoundError:
+            pass
+
+
+def assemble(spool):
+    """
+    Concatenates every submitted document whose chunks are all synthesized.
+
+    :param spool: path to the spool directory
+    :return: int: number of documents still waiting for chunks, documents with failed chunks are not counted
+    """
+    docs, pending, leased, done, failed = _dirs(spool)
+    waiting = 0
+    for name in os.listdir(docs):
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(docs, name), 'r', encoding='UTF-8') as f:
+            doc = json.load(f)
+
+        ext = PROFILES[doc['profile']]['ext']
+        paths = [os.path.join(done, f'{digest}.{ext}') for digest in doc['chunks']]
+        if any(os.path.isfile(os.path.join(failed, f'{digest}.json')) for digest in doc['chunks']):
+            logging.error(f"{doc['outfile']} has failed chunks, see {failed}")
+            continue
+        if not all(map(os.path.isfile, paths)):
+            waiting += 1
+            continue
+
+        concatenate(paths, f"{doc['outfile']}.{ext}", doc['profile'])
+        os.remove(os.path.join(docs, name))
+        logging.info(f"assembled {doc['outfile']}.{ext}")
+    return waiting
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    args = argparse.ArgumentParser(description='Synthesizes documents through a shared spool directory.')
+    args.add_argument('spool', help='path to the spool directory')
+    commands = args.add_subparsers(dest='command', required=True)
+
+    submit_args = commands.add_parser('submit', help='submit ssml from stdin')
+    submit_args.add_argument('outfile', help='path to output audio without extension')
+    submit_args.add_argument('--profile', choices=PROFILES.keys(), default='mp3', help='audio encoding profile')
+    submit_args.add_argument('--sample-rate', type=int,
+                             help='sample rate in Hz, defaults to 24000 for wav and 16000 for opus')
+
+    worker_args = commands.add_parser('worker', help='synthesize pending chunks')
+    worker_args.add_argument('--backend', choices=BACKENDS.keys(), default='google', help='synthesis backend')
+    worker_args.add_argument('--lease', type=float, default=LEASE, help='lease timeout in seconds')
+    worker_args.add_argument('--exit-when-idle', action='store_true', help='exit when there is no work left')
+    worker_args.add_argument('--hedge', action='store_true', help='send a duplicate request when a request is slow')
+
+    assemble_args = commands.add_parser('assemble', help='assemble finished documents')
+    assemble_args.add_argument('--wait', action='store_true', help='wait until all documents are assembled')
+
+    args = args.parse_args()
+
+    if args.command == 'submit':
+        submit(sys.stdin.read(), args.outfile, args.spool, args.profile, args.sample_rate)
+    elif args.command == 'worker':
+        worker(args.spool, args.backend, args.lease, exit_when_idle=args.exit_when_idle, hedge=args.hedge)
+    else:
+        while assemble(args.spool) > 0 and args.wait:
+            time.sleep(5.0)
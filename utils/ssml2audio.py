@@ -3,27 +3,202 @@
 Covers speech synthesis markup language to audio.
 """
 
+import collections
+import hashlib
+import io
+import json
 import logging
-import socket
 import os
+import shutil
+import subprocess
 import tempfile
+import threading
+import time
+import wave
 
+from google.api_core import exceptions
 from google.cloud import texttospeech
 
+from utils.retry import ReliableSynthesizer
+from utils.scheduler import CHARS_PER_MINUTE, REQUESTS_PER_MINUTE
+
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "credentials.json"
 
-socket.setdefaulttimeout(300)  # hack to avoid timeout error
+# errors after which a request is retried
+RETRYABLE = (exceptions.DeadlineExceeded, exceptions.ServiceUnavailable, exceptions.TooManyRequests,
+             exceptions.ResourceExhausted, exceptions.InternalServerError, TimeoutError, ConnectionError)
+
+LANGUAGE_CODE = 'cs-CZ'
+VOICE_NAME = 'cs-CZ-Wavenet-A'
+SPEAKING_RATE = 1.20
+
+# audio encoding profiles
+# mp3 - the original behaviour, widely supported
+# opus - low bitrate speech, smallest transfer and storage, the API has no bitrate setting so a lower
+#        sample rate (wideband speech) is requested instead
+# wav - lossless, concatenated without ffmpeg
+# the sample rate of any profile may be overridden, see profile_config
+PROFILES = {
+    'mp3': {
+        'encoding': texttospeech.AudioEncoding.MP3,
+        'ext': 'mp3',
+        'config': {},
+    },
+    'opus': {
+        'encoding': texttospeech.AudioEncoding.OGG_OPUS,
+        'ext': 'ogg',
+        'config': {'sample_rate_hertz': 16000},
+    },
+    'wav': {
+        'encoding': texttospeech.AudioEncoding.LINEAR16,
+        'ext': 'wav',
+        'config': {'sample_rate_hertz': 24000},
+    },
+}
+
+
+def profile_config(profile, sample_rate=None):
+    """
+    Builds the audio config parameters of a profile.
+
+    :param profile: str: audio encoding profile, one of PROFILES
+    :param sample_rate: int: sample rate in Hz, None for the default of the profile
+    :return: dict: parameters of texttospeech.AudioConfig
+    """
+    config = dict(PROFILES[profile]['config'])
+    if sample_rate is not None:
+        config['sample_rate_hertz'] = sample_rate
+    return config
+
+
+def concatenate_wav(paths, outfile):
+    """
+    Concatenates LINEAR16 wav files by copying their frames.
+
+    :param paths: list of paths to wav files
+    :param outfile: str: path to output wav
+    """
+    with wave.open(outfile, 'wb') as out:
+        for num, path in enumerate(paths):
+            with wave.open(path, 'rb') as part:
+                if num == 0:
+                    out.setparams(part.getparams())
+                out.writeframes(part.readframes(part.getnframes()))
+
+
+def concatenate_ffmpeg(paths, outfile):
+    """
+    Concatenates compressed audio files using ffmpeg without re-encoding.
+
+    :param paths: list of paths to audio files
+    :param outfile: str: path to output file
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', encoding='UTF-8', delete=False) as f:
+        f.write("\n".join(map(lambda x: f"file '{os.path.realpath(x)}'", paths)))
+    if os.system(f'ffmpeg -y -f concat -safe 0 -i "{f.name}" -c copy "{outfile}"') != 0:
+        logging.error(f'ffmpeg failed to concatenate {outfile}')
+    os.remove(f.name)
+
+
+def audio_duration(path):
+    """
+    Finds the duration of an audio file.
+
+    :param path: path to audio file
+    :return: float: duration in seconds
+    """
+    if path.endswith('.wav'):
+        with wave.open(path, 'rb') as f:
+            return f.getnframes() / f.getframerate()
+    output = subprocess.check_output(['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+                                      '-of', 'default=noprint_wrappers=1:nokey=1', path], encoding='UTF-8')
+    return float(output.strip())
+
+
+def report_size(profile, transferred, outfile, reused=0, chunk_dir=None):
+    """
+    Logs bytes transferred and stored per minute of audio. Transfer per minute is only reported if no chunk
+    was reused, reused chunks are not part of the transfer.
+
+    :param profile: str: name of the encoding profile
+    :param transferred: int: bytes received from the TTS API
+    :param outfile: str: path to the assembled audio
+    :param reused: int: number of chunks reused from a previous synthesis
+    :param chunk_dir: str: path to the kept chunks, they are counted as stored, None if chunks were not kept
+    """
+    if not os.path.isfile(outfile):
+        logging.warning(f'{outfile} was not created')
+        return
+
+    stored = os.path.getsize(outfile)
+    if chunk_dir is not None:
+        stored += sum(entry.stat().st_size for entry in os.scandir(chunk_dir) if entry.is_file())
+    try:
+        minutes = audio_duration(outfile) / 60
+    except (subprocess.CalledProcessError, FileNotFoundError, ValueError):
+        logging.warning(f'could not determine duration of {outfile}')
+        return
+
+    if minutes == 0:
+        return
 
-tmpdir = tempfile.TemporaryDirectory()
+    if reused == 0:
+        transfer = f'{transferred / minutes / 1024:.1f} KiB/min transferred'
+    else:
+        transfer = f'{transferred / 1024:.1f} KiB transferred ({reused} reused chunks excluded)'
+    cache = '' if chunk_dir is None else ' including chunks'
+    logging.info(f'profile {profile}: {minutes:.2f} min of audio, {transfer}, '
+                 f'{stored / minutes / 1024:.1f} KiB/min stored{cache}')
+
+
+def chunk_hash(ssml_line, profile, sample_rate=None):
+    """
+    Identifies a synthesized chunk by its content and synthesis settings.
+
+    :param ssml_line: str: ssml of the chunk
+    :param profile: str: audio encoding profile
+    :param sample_rate: int: sample rate in Hz, None for the default of the profile
+    :return: str: hex digest
+    """
+    rate = profile_config(profile, sample_rate).get('sample_rate_hertz', '')
+    key = f"{LANGUAGE_CODE}\n{VOICE_NAME}\n{SPEAKING_RATE}\n{profile}\n{rate}\n{ssml_line}"
+    return hashlib.sha256(key.encode('UTF-8')).hexdigest()
+
+
+def load_manifest(outfile):
+    """
+    Loads the manifest of a previous synthesis of outfile.
+
+    :param outfile: str: path to output audio without extension
+    :return: dict: profile and ordered list of chunk hashes
+    """
+    try:
+        with open(f"{outfile}.manifest.json", 'r', encoding='UTF-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'profile': 'mp3', 'chunks': []}
+
+
+def write_manifest(outfile, profile, hashes):
+    """
+    Writes the manifest mapping the output audio to its chunks.
+
+    :param outfile: str: path to output audio without extension
+    :param profile: str: audio encoding profile
+    :param hashes: list of chunk hashes in order
+    """
+    with open(f"{outfile}.manifest.json", 'w', encoding='UTF-8') as f:
+        json.dump({'profile': profile, 'chunks': hashes}, f, indent=1)
 
 
 # noinspection PyTypeChecker
-def ssml2audio(ssml_text, outfile):
+def google_synthesizer(profile, sample_rate=None):
     """
-    Uses google cloud text to speech to convert ssml to audio.
+    Creates a google cloud text to speech backend.
 
-    :param ssml_text: str: speech synthesis markup language file
-    :param outfile: str: path to output mp3
+    :param profile: str: audio encoding profile, one of PROFILES
+    :param sample_rate: int: sample rate in Hz, None for the default of the profile
+    :return: function taking a ssml chunk and a timeout and returning audio bytes
     """
 
     # Instantiates a client
@@ -31,54 +206,262 @@ def ssml2audio(ssml_text, outfile):
 
     # Builds the voice request, selects the language code ("cs-CZ")
     voice = texttospeech.VoiceSelectionParams(
-        language_code='cs-CZ',
-        name="cs-CZ-Wavenet-A"
+        language_code=LANGUAGE_CODE,
+        name=VOICE_NAME
     )
 
     # Selects the type of audio file to return
     audio_config = texttospeech.AudioConfig(
-        audio_encoding=texttospeech.AudioEncoding.MP3,
-        speaking_rate=1.20
+        audio_encoding=PROFILES[profile]['encoding'],
+        speaking_rate=SPEAKING_RATE,
+        **profile_config(profile, sample_rate)
     )
 
+    def synthesize(ssml_line, timeout):
+        # Sets the text input to be synthesized
+        synthesis_input = texttospeech.SynthesisInput(ssml=ssml_line)
+
+        # Performs the text-to-speech request on the text input with the selected
+        # voice parameters and audio file type
+        response = client.synthesize_speech(input=synthesis_input, voice=voice, audio_config=audio_config,
+                                            timeout=timeout)
+        return response.audio_content
+
+    return synthesize
+
+
+def silence_synthesizer(profile, sample_rate=None):
+    """
+    Creates a stand-in backend returning silence, for testing without the TTS API.
+    One character of ssml gives one millisecond of audio.
+
+    :param profile: str: audio encoding profile, must be 'wav'
+    :param sample_rate: int: sample rate in Hz, None for the default of the profile
+    :return: function taking a ssml chunk and a timeout and returning audio bytes
+    """
+    if PROFILES[profile]['encoding'] != texttospeech.AudioEncoding.LINEAR16:
+        raise ValueError('the silence backend only supports the wav profile')
+
+    rate = profile_config(profile, sample_rate)['sample_rate_hertz']
+
+    def synthesize(ssml_line, timeout):
+        out = io.BytesIO()
+        with wave.open(out, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(rate)
+            f.writeframes(b'\0\0' * (rate * len(ssml_line) // 1000))
+        return out.getvalue()
+
+    return synthesize
+
+
+class QuotaWindow:
+    """
+    Characters and requests sent in the last minute, enforces a quota the way the TTS API does.
+    A minute lasts minute seconds, tests shorten it so that the quota runs out quickly.
+    """
+
+    def __init__(self, chars_per_minute=CHARS_PER_MINUTE, requests_per_minute=REQUESTS_PER_MINUTE, minute=60.0):
+        self.chars_per_minute = chars_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.minute = minute
+        self.sent = collections.deque()  # (time, chars) of requests in the last minute
+        self.chars = 0
+        self.lock = threading.Lock()
+
+    def spend(self, chars):
+        """
+        Records a request.
+
+        :param chars: int: length of the request
+        :raise exceptions.TooManyRequests: if the request exceeds the quota
+        """
+        with self.lock:
+            now = time.monotonic()
+            while len(self.sent) > 0 and self.sent[0][0] <= now - self.minute:
+                self.chars -= self.sent.popleft()[1]
+            if self.chars + chars > self.chars_per_minute or len(self.sent) + 1 > self.requests_per_minute:
+                raise exceptions.TooManyRequests(f'quota exceeded, {self.chars} characters and '
+                                                 f'{len(self.sent)} requests in the last minute')
+            self.sent.append((now, chars))
+            self.chars += chars
+
+
+# quota of the limited backend, shared by all its instances like the quota of a project
+limited_quota = QuotaWindow()
+
+
+def limited_synthesizer(profile, sample_rate=None):
+    """
+    Creates a stand-in backend returning silence and failing with TooManyRequests above limited_quota,
+    for testing quota handling without the TTS API.
+
+    :param profile: str: audio encoding profile, must be 'wav'
+    :param sample_rate: int: sample rate in Hz, None for the default of the profile
+    :return: function taking a ssml chunk and a timeout and returning audio bytes
+    """
+    silence = silence_synthesizer(profile, sample_rate)
+
+    def synthesize(ssml_line, timeout):
+        limited_quota.spend(len(ssml_line))
+        return silence(ssml_line, timeout)
+
+    return synthesize
+
+
+BACKENDS = {
+    'google': google_synthesizer,
+    'silence': silence_synthesizer,
+    'limited': limited_synthesizer,
+}
+
+
+def split_chunks(ssml_text):
+    """
+    Splits ssml into chunks synthesized by a single request.
+
+    :param ssml_text: str: speech synthesis markup language file or a section of it
+    :return: list of str: ssml chunks
+    """
     lines = list(filter(lambda line: line.strip() != '', ssml_text.splitlines()))
-    paths = []
 
-    if any(map(lambda line: len(line) > 5000, lines)):
-        logging.fatal("5000 characters limit exceeded")
-        logging.debug(list(filter(lambda line: len(line[1]) > 5000, lines)))
+    if any(map(lambda line: len(line.encode('UTF-8')) > 5000, lines)):
+        logging.fatal("5000 bytes limit exceeded")
+        logging.debug(list(filter(lambda line: len(line.encode('UTF-8')) > 5000, lines)))
         exit(1)
 
-    filename = os.path.split(outfile)[1]
+    return lines
 
-    for num, ssml_line in enumerate(lines):
-        path = os.path.join(tmpdir.name, f"{filename}{num}.mp3")
 
-        # Sets the text input to be synthesized
-        synthesis_input = texttospeech.SynthesisInput(ssml=ssml_line)
+def concatenate(paths, outfile, profile):
+    """
+    Concatenates synthesized chunks using the method native to the profile's format.
 
-        # Performs the text-to-speech request on the text input with the selected
-        # voice parameters and audio file type
-        response = client.synthesize_speech(input=synthesis_input, voice=voice, audio_config=audio_config,
-                                            timeout=300.0)
+    :param paths: list of paths to audio chunks in order
+    :param outfile: str: path to output audio with extension
+    :param profile: str: audio encoding profile
+    """
+    if len(paths) == 0:
+        logging.warning(f'no audio to concatenate into {outfile}')
+        return
 
-        # Writes the synthetic audio to the output file.
-        with open(path, 'wb') as out:
-            out.write(response.audio_content)
-            logging.info(f'Audio content written to file {path}')
+    if PROFILES[profile]['encoding'] == texttospeech.AudioEncoding.LINEAR16:
+        concatenate_wav(paths, outfile)
+    else:
+        concatenate_ffmpeg(paths, outfile)
+
+
+def ssml2audio(ssml_text, outfile, profile='mp3', backend='google', hedge=False, scheduler=None, sample_rate=None,
+               incremental=False):
+    """
+    Uses google cloud text to speech to convert ssml to audio.
 
+    :param ssml_text: str: speech synthesis markup language file or an iterable of its sections,
+        sections are read one at a time
+    :param outfile: str: path to output audio without extension
+    :param profile: str: audio encoding profile, one of PROFILES
+    :param backend: str: synthesis backend, one of BACKENDS
+    :param hedge: bool: send a duplicate request when a request is slower than usual
+    :param scheduler: QuotaScheduler shared with other documents converted at the same time
+    :param sample_rate: int: sample rate in Hz, None for the default of the profile
+    :param incremental: bool: keep synthesized chunks next to the output, so that after an edit only the changed
+        chunks are synthesized, otherwise chunks are removed after they are concatenated
+    """
+
+    acquire = None if scheduler is None else lambda chars: scheduler.acquire(outfile, chars)
+    synthesize = ReliableSynthesizer(BACKENDS[backend](profile, sample_rate), RETRYABLE, hedge=hedge, acquire=acquire)
+
+    if isinstance(ssml_text, str):
+        ssml_text = [ssml_text]
+
+    if incremental:
+        chunk_dir = f"{outfile}.chunks"
+        os.makedirs(chunk_dir, exist_ok=True)
+    else:
+        # next to the output rather than in /tmp, chunks of a long document do not fit in a tmpfs
+        chunk_dir = tempfile.mkdtemp(prefix=f"{os.path.basename(outfile)}.", suffix='.chunks',
+                                     dir=os.path.dirname(outfile) or '.')
+    try:
+        _synthesize_chunks(ssml_text, outfile, profile, sample_rate, synthesize, scheduler, chunk_dir, incremental)
+    finally:
+        if not incremental:
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+
+
+def _synthesize_chunks(ssml_text, outfile, profile, sample_rate, synthesize, scheduler, chunk_dir, incremental):
+    """
+    Synthesizes chunks missing in chunk_dir and concatenates them to the output.
+
+    :param ssml_text: iterable of ssml sections
+    :param outfile: str: path to output audio without extension
+    :param profile: str: audio encoding profile, one of PROFILES
+    :param sample_rate: int: sample rate in Hz, None for the default of the profile
+    :param synthesize: ReliableSynthesizer
+    :param scheduler: QuotaScheduler or None
+    :param chunk_dir: str: directory of synthesized chunks
+    :param incremental: bool: reuse chunks of the previous synthesis and write the manifest
+    """
+    ext = PROFILES[profile]['ext']
+    manifest = load_manifest(outfile) if incremental else {'profile': profile, 'chunks': []}
+
+    paths = []
+    hashes = []
+    transferred = 0
+    reused = 0
+
+    for ssml_line in (line for section in ssml_text for line in split_chunks(section)):
+        digest = chunk_hash(ssml_line, profile, sample_rate)
+        path = os.path.join(chunk_dir, f"{digest}.{ext}")
+        hashes.append(digest)
         paths.append(path)
 
-    # concatenate
-    with open(os.path.join(tmpdir.name, "paths.txt"), 'w', encoding='UTF-8') as f:
-        f.write("\n".join(map(lambda x: f"file '{x}'", paths)))
-    os.system(f'ffmpeg -y -f concat -safe 0 -i "{os.path.join(tmpdir.name, "paths.txt")}" "{outfile}.mp3"')
+        if os.path.isfile(path):
+            reused += 1
+            continue
+
+        audio = synthesize(ssml_line)
+
+        # Writes the synthetic audio to the output file.
+        with open(path + '.part', 'wb') as out:
+            out.write(audio)
+        os.replace(path + '.part', path)
+        logging.info(f'Audio content written to file {path}')
+
+        transferred += len(audio)
+
+    logging.info(f'{reused} of {len(hashes)} chunks reused from previous synthesis')
+    synthesize.report()
+    if scheduler is not None:
+        scheduler.release(outfile)
+
+    if incremental:
+        # drop chunks no longer used by the document
+        for digest in set(manifest['chunks']) - set(hashes):
+            path = os.path.join(chunk_dir, f"{digest}.{PROFILES[manifest['profile']]['ext']}")
+            if os.path.isfile(path):
+                os.remove(path)
+        write_manifest(outfile, profile, hashes)
 
-    # delete temporary files
-    tmpdir.cleanup()
+    concatenate(paths, f"{outfile}.{ext}", profile)
+
+    report_size(profile, transferred, f"{outfile}.{ext}", reused, chunk_dir if incremental else None)
 
 
 if __name__ == '__main__':
+    import argparse
     import sys
 
-    ssml2audio(sys.stdin.read(), "output")
+    args = argparse.ArgumentParser(description='Converts ssml from stdin to audio.')
+    args.add_argument('--profile', choices=PROFILES.keys(), default='mp3', help='audio encoding profile')
+    args.add_argument('--sample-rate', type=int,
+                      help='sample rate in Hz, defaults to 24000 for wav and 16000 for opus')
+    args.add_argument('--backend', choices=BACKENDS.keys(), default='google', help='synthesis backend')
+    args.add_argument('--hedge', action='store_true', help='send a duplicate request when a request is slow')
+    args.add_argument('--incremental', action='store_true',
+                      help='keep synthesized chunks, after an edit only the changed chunks are synthesized')
+
+    args = args.parse_args()
+
+    ssml2audio(sys.stdin.read(), "output", args.profile, args.backend, args.hedge, sample_rate=args.sample_rate,
+               incremental=args.incremental)
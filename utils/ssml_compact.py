@@ -0,0 +1,234 @@
+#! ./venv/bin/python3
+"""
+Removes ssml markup which has no audible effect, reducing billed characters and request size.
+
+    - duplicate whitespace
+    - empty <emphasis>, <s> and <p> elements
+    - <emphasis> nested in an <emphasis> of the same level
+    - adjacent <emphasis> elements of the same level (merged)
+    - <s> around text ending with sentence punctuation and containing no other, periods of ordinals and
+      abbreviations are ambiguous so <s> is kept if the final period follows a number or a single word
+    - consecutive <break/> elements (merged into one with the total time)
+    - <p> around a whole line, every line is a separate request
+"""
+import logging
+import re
+
+RE_TAG = r"(<[^>]*>)"
+RE_BREAK_TIME = r'<break time="(\d+(?:\.\d+)?)(m?s)"\s*/>'
+
+# text ending with these characters is read as a sentence without <s>
+SENTENCE_END = '.!?…'
+# characters which may follow the sentence end
+SENTENCE_END_TRAILING = '"“”)]} '
+
+
+class _Element:
+    def __init__(self, name, tag):
+        self.name = name
+        self.tag = tag  # the original start tag
+        self.children = []
+
+
+def _parse(line):
+    """
+    Parses a ssml line into a tree.
+
+    :param line: str: ssml
+    :return: _Element: root or None if the markup is not well-formed
+    """
+    root = _Element(None, '')
+    stack = [root]
+    for token in re.split(RE_TAG, line):
+        if token == '':
+            continue
+        if not token.startswith('<'):
+            stack[-1].children.append(token)
+        elif token.startswith('</'):
+            if stack[-1].name != token[2:-1].strip():
+                return None
+            stack.pop()
+        elif token.endswith('/>'):
+            stack[-1].children.append(_Element(token[1:-2].split()[0], token))
+        else:
+            element = _Element(token[1:-1].split()[0], token)
+            stack[-1].children.append(element)
+            stack.append(element)
+    if len(stack) != 1:
+        return None
+    return root
+
+
+def _text(node):
+    if isinstance(node, str):
+        return node
+    return ''.join(map(_text, node.children))
+
+
+def _is_empty(node):
+    """
+    Checks if a node has no audible content.
+    """
+    if isinstance(node, str):
+        return node.strip() == ''
+    if node.name not in ['emphasis', 's', 'p', None]:
+        return False
+    return all(map(_is_empty, node.children))
+
+
+def _emphasis_level(element):
+    level = re.search(r'level="(\w+)"', element.tag)
+    return level.group(1) if level is not None else 'moderate'
+
+
+def _break_ms(element):
+    time = re.fullmatch(RE_BREAK_TIME, element.tag)
+    if time is None:
+        return None
+    return float(time.group(1)) * (1 if time.group(2) == 'ms' else 1000)
+
+
+def _compact(element, level=None):
+    """
+    Compacts children of an element in place.
+
+    :param element: _Element
+    :param level: emphasis level of the enclosing emphasis
+    :return: list of nodes replacing the element
+    """
+    children = []
+    for child in element.children:
+        if isinstance(child, str):
+            children.append(child)
+        elif child.name == 'emphasis':
+            child_level = _emphasis_level(child)
+            replacement = _compact(child, child_level)
+            if child_level == level and len(replacement) > 0 and isinstance(replacement[0], _Element):
+                children.extend(replacement[0].children)  # nested emphasis of the same level
+            else:
+                children.extend(replacement)
+        elif child.name == 'break':
+            children.append(child)
+        else:
+            children.extend(_compact(child, level))
+
+    merged = []
+    for child in children:
+        # whitespace between elements which are merged later
+        if isinstance(child, str) and len(merged) > 0 and isinstance(merged[-1], str):
+            merged[-1] += child
+            continue
+
+        if isinstance(child, _Element) and len(merged) > 0:
+            previous = merged[-1]
+            separator = ''
+            if isinstance(previous, str) and previous.strip() == '' and len(merged) > 1:
+                separator = previous
+                previous = merged[-2]
+
+            if isinstance(previous, _Element) and previous.name == child.name == 'emphasis' and \
+                    _emphasis_level(previous) == _emphasis_level(child):
+                if separator:
+                    merged.pop()
+                    previous.children.append(separator)
+                previous.children.extend(child.children)
+                continue
+
+            if isinstance(previous, _Element) and previous.name == child.name == 'break' and \
+                    _break_ms(previous) is not None and _break_ms(child) is not None:
+                if separator:
+                    merged.pop()
+                ms = _break_ms(previous) + _break_ms(child)
+                time = f'{ms / 1000:g}s' if ms % 1000 == 0 else f'{ms:g}ms'
+                previous.tag = f'<break time="{time}"/>'
+                continue
+
+        merged.append(child)
+    element.children = merged
+
+    if element.name in ['emphasis', 's', 'p'] and _is_empty(element):
+        return [' '] if _text(element) != '' else []
+
+    if element.name == 's':
+        text = _text(element).rstrip(SENTENCE_END_TRAILING)
+        body = text.rstrip(SENTENCE_END)
+        ambiguous = text.endswith('.') and (body.strip() == '' or body[-1].isdigit() or len(body.split()) == 1)
+        if body != text and not ambiguous and not any(char in body for char in SENTENCE_END):
+            return [' '] + element.children + [' ']
+
+    return [element]
+
+
+def _serialize(node):
+    if isinstance(node, str):
+        return node
+    if node.tag.endswith('/>'):
+        return node.tag
+    return node.tag + ''.join(map(_serialize, node.children)) + f'</{node.name}>'
+
+
+def compact_line(line):
+    """
+    Compacts one line of ssml. Lines which are not well-formed are only stripped of duplicate whitespace.
+
+    :param line: str: ssml
+    :return: str: compacted ssml
+    """
+    line = re.sub(r'\s+', ' ', line).strip()
+    root = _parse(line)
+    if root is None:
+        return line
+
+    _compact(root)
+    nodes = [node for node in root.children if not _is_empty(node) or isinstance(node, _Element)]
+    if len(nodes) == 1 and isinstance(nodes[0], _Element) and nodes[0].name == 'p':
+        nodes = nodes[0].children
+    line = ''.join(map(_serialize, nodes))
+
+    line = re.sub(r'\s+', ' ', line)
+    line = re.sub(r'(<(?:p|s)>) ', r'\1', line)
+    line = re.sub(r' (</(?:p|s)>)', r'\1', line)
+    return line.strip()
+
+
+def compact_ssml(ssml):
+    """
+    Compacts every line of ssml and logs the savings.
+
+    :param ssml: str: ssml, one request per line
+    :return: str: compacted ssml
+    """
+    out = '\n'.join(filter(lambda line: line != '', map(compact_line, ssml.splitlines())))
+
+    before = len(ssml.encode('UTF-8'))
+    after = len(out.encode('UTF-8'))
+    logging.info(f'ssml compaction saved {len(ssml) - len(out)} characters, {before - after} bytes '
+                 f'({(before - after) / max(before, 1):.1%})')
+    return out
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    args = argparse.ArgumentParser(description='Compacts ssml from stdin or measures savings on a corpus.')
+    args.add_argument('files', nargs='*', help='ssml files to measure, stdin is compacted if none are given')
+    args = args.parse_args()
+
+    if len(args.files) == 0:
+        print(compact_ssml(sys.stdin.read()))
+        sys.exit(0)
+
+    total_before = total_after = 0
+    for path in args.files:
+        with open(path, 'r', encoding='UTF-8') as f:
+            ssml = f.read()
+        compacted = '\n'.join(filter(lambda line: line != '', map(compact_line, ssml.splitlines())))
+        before, after = len(ssml.encode('UTF-8')), len(compacted.encode('UTF-8'))
+        total_before += before
+        total_after += after
+        print(f'{path}: {before} -> {after} bytes ({(before - after) / max(before, 1):.1%} saved)')
+    print(f'total: {total_before} -> {total_after} bytes '
+          f'({(total_before - total_after) / max(total_before, 1):.1%} saved)')
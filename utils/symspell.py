@@ -0,0 +1,237 @@
+#! ./venv/bin/python3
+"""
+SymSpell-style spelling correction backed by a precomputed deletion index.
+
+The index is built once from a word list (one word per line, e.g. the output of
+`aspell -l cs dump master | aspell -l cs expand | tr ' ' '\\n'`) and stored as a directory of numpy arrays
+which are memory-mapped at load.
+
+Index layout:
+    words.npy    - utf-8 encoded words sorted by their normalized form, concatenated
+    offsets.npy  - start of each word in words.npy
+    exact.npy    - sorted hashes of all words, used for dictionary lookups
+    prefixes.npy - index of the first word of each distinct normalized prefix
+    keys.npy     - sorted hashes of deletions of the normalized prefixes
+    ids.npy      - prefix id for each key
+    settings.npy - max_distance and prefix_length the index was built with
+"""
+import array
+import hashlib
+import logging
+import os
+
+import numpy as np
+
+from utils.tts_preprocess import diacritics
+
+# only the prefix of each word is used for deletions, longer words are verified by distance
+# most czech words are shorter, so inflected forms sharing a stem get separate deletions and the number of
+# candidates of a lookup stays bounded by the forms within the distance
+PREFIX_LENGTH = 12
+
+MAX_DISTANCE = 2
+
+
+def normalize(word):
+    """
+    Normalizes a word the same way the weighted distance does (lowercase, no diacritics).
+
+    :param word: str: word
+    :return: str: normalized word
+    """
+    return word.lower().translate(diacritics)
+
+
+def _hash(text):
+    """
+    Hashes a string to a 64-bit integer.
+
+    :param text: str: text
+    :return: int: hash
+    """
+    return int.from_bytes(hashlib.blake2b(text.encode('UTF-8'), digest_size=8).digest(), 'little')
+
+
+def _deletes(word, max_distance):
+    """
+    Generates all strings created by deleting up to max_distance characters from word.
+
+    :param word: str: word
+    :param max_distance: int: maximal number of deletions
+    :return: set: deletions including the word itself
+    """
+    out = {word}
+    edge = {word}
+    for _ in range(max_distance):
+        edge = {w[:i] + w[i + 1:] for w in edge for i in range(len(w))}
+        out |= edge
+    return out
+
+
+def build(wordlist, index_dir, max_distance=MAX_DISTANCE, prefix_length=PREFIX_LENGTH):
+    """
+    Builds a deletion index from a word list.
+
+    :param wordlist: path to a word list with one word per line
+    :param index_dir: path to the output directory
+    :param max_distance: int: maximal edit distance supported by the index
+    :param prefix_length: int: length of the prefix used for deletions
+    """
+    with open(wordlist, 'r', encoding='UTF-8') as f:
+        words = {line.strip() for line in f if line.strip() != ''}
+    words = sorted(words, key=lambda word: (normalize(word), word))
+    logging.info(f'building index for {len(words)} words')
+
+    encoded = [word.encode('UTF-8') for word in words]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(word) for word in encoded])
+
+    exact = np.unique(np.array([_hash(word) for word in words], dtype=np.uint64))
+
+    # words are sorted by normalized form, so words sharing a prefix are contiguous
+    # deletions are collected in typed arrays, a set of tuples would not fit in memory for large word lists
+    prefixes = []
+    keys = array.array('Q')
+    ids = array.array('I')
+    last = None
+    for num, word in enumerate(words):
+        prefix = normalize(word)[:prefix_length]
+        if prefix != last:
+            prefixes.append(num)
+            last = prefix
+            for delete in _deletes(prefix, max_distance):
+                keys.append(_hash(delete))
+                ids.append(len(prefixes) - 1)
+    prefixes.append(len(words))
+
+    keys = np.frombuffer(keys, dtype=np.uint64)
+    ids = np.frombuffer(ids, dtype=np.uint32)
+    order = np.lexsort((ids, keys))
+    keys, ids = keys[order], ids[order]
+    logging.info(f'{len(prefixes) - 1} prefixes, {len(keys)} deletions')
+
+    os.makedirs(index_dir, exist_ok=True)
+    np.save(os.path.join(index_dir, 'words.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    np.save(os.path.join(index_dir, 'offsets.npy'), offsets)
+    np.save(os.path.join(index_dir, 'exact.npy'), exact)
+    np.save(os.path.join(index_dir, 'prefixes.npy'), np.array(prefixes, dtype=np.uint32))
+    np.save(os.path.join(index_dir, 'keys.npy'), keys)
+    np.save(os.path.join(index_dir, 'ids.npy'), ids)
+    np.save(os.path.join(index_dir, 'settings.npy'), np.array([max_distance, prefix_length], dtype=np.uint32))
+
+
+class SymSpell:
+    """
+    Memory-mapped deletion index answering dictionary lookups and correction candidates.
+    """
+
+    def __init__(self, index_dir):
+        def load(name):
+            return np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r')
+
+        # lookups must use the settings of the build, deletions of a different prefix do not match
+        self.max_distance, self.prefix_length = (int(value) for value in load('settings'))
+
+        self.words = load('words')
+        self.offsets = load('offsets')
+        self.exact = load('exact')
+        self.prefixes = load('prefixes')
+        self.keys = load('keys')
+        self.ids = load('ids')
+
+    def _word(self, num):
+        return bytes(self.words[self.offsets[num]:self.offsets[num + 1]]).decode('UTF-8')
+
+    def _contains(self, word):
+        key = np.uint64(_hash(word))
+        pos = np.searchsorted(self.exact, key)
+        return pos < len(self.exact) and self.exact[pos] == key
+
+    def check(self, word):
+        """
+        Checks if word is in the dictionary. Capitalized words are also checked in lowercase.
+
+        :param word: str: word
+        :return: bool
+        """
+        return self._contains(word) or (word[:1].isupper() and self._contains(word.lower()))
+
+    def candidates(self, word):
+        """
+        Finds dictionary words within max_distance deletions of the word's prefix.
+
+        :param word: str: misspelled word
+        :return: list of str: candidate words
+        """
+        prefix = normalize(word)[:self.prefix_length]
+        hashes = np.array(sorted(_hash(delete) for delete in _deletes(prefix, self.max_distance)), dtype=np.uint64)
+        left = np.searchsorted(self.keys, hashes, side='left')
+        right = np.searchsorted(self.keys, hashes, side='right')
+
+        prefix_ids = set()
+        for start, end in zip(left, right):
+            prefix_ids.update(self.ids[start:end].tolist())
+
+        out = []
+        for prefix_id in sorted(prefix_ids):
+            for num in range(self.prefixes[prefix_id], self.prefixes[prefix_id + 1]):
+                candidate = self._word(num)
+                # cheap length filter before the weighted distance, in characters as diacritics cost nothing
+                if abs(len(candidate) - len(word)) > 2 * self.max_distance:
+                    continue
+                out.append(candidate)
+        return out
+
+    def suggest(self, word, distance):
+        """
+        Finds the best corrections of a word.
+
+        :param word: str: misspelled word
+        :param distance: function computing the weighted distance of two words
+        :return: list of (str, float): corrections within max_distance sorted by distance
+        """
+        out = []
+        for candidate in self.candidates(word):
+            dist = distance(candidate, word)
+            if dist <= self.max_distance:
+                out.append((candidate, dist))
+        out.sort(key=lambda item: item[1])
+        return out
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    args = argparse.ArgumentParser(description='Builds and benchmarks a SymSpell correction index.')
+    commands = args.add_subparsers(dest='command', required=True)
+
+    build_args = commands.add_parser('build', help='build an index from a word list')
+    build_args.add_argument('wordlist', help='path to a word list with one word per line')
+    build_args.add_argument('index', help='path to the output index directory')
+
+    bench_args = commands.add_parser('benchmark', help='compare corrections with enchant')
+    bench_args.add_argument('index', help='path to the index directory')
+    bench_args.add_argument('pairs', help='path to a file with "ocr output<TAB>expected word" on each line')
+
+    args = args.parse_args()
+
+    if args.command == 'build':
+        build(args.wordlist, args.index)
+    else:
+        from utils.tts_preprocess import TTSPreprocessor
+
+        with open(args.pairs, 'r', encoding='UTF-8') as f:
+            pairs = [line.rstrip('\n').split('\t') for line in f if '\t' in line]
+
+        for name, preprocessor in [('enchant', TTSPreprocessor(full_names=False)),
+                                   ('symspell', TTSPreprocessor(full_names=False, correction_index=args.index))]:
+            start = time.perf_counter()
+            correct = sum(preprocessor.correct_word(wrong) == expected for wrong, expected in pairs)
+            elapsed = time.perf_counter() - start
+            print(f'{name}: {correct}/{len(pairs)} correct, {elapsed / max(len(pairs), 1) * 1000:.2f} ms per word')
+
+        candidates = sum(len(SymSpell(args.index).candidates(wrong)) for wrong, _ in pairs)
+        print(f'symspell: {candidates / max(len(pairs), 1):.1f} candidates per word')
@@ -9,6 +9,7 @@ from weighted_levenshtein import lev
 import numpy as np
 
 import utils.roman_num as roman
+from utils.abbreviations import AbbreviationExpander, load_expansions
 
 diacritics = {
     'ě': 'e',
@@ -54,17 +55,28 @@ class TTSPreprocessor:
         Ordinal numbers
         Full names
         Arrows
+        Abbreviations
         Autocorrect
     """
 
-    def __init__(self, use_roman=True, use_ordinal=True, full_names=True, arrows=True, autocorrect=True):
+    def __init__(self, use_roman=True, use_ordinal=True, full_names=True, arrows=True, autocorrect=True,
+                 correction_index=None, abbreviations=True):
         self.use_roman = use_roman
         self.use_ordinal = use_ordinal
         self.full_names = full_names
         self.arrows = arrows
         self.autocorrect = autocorrect
+        self.abbreviations = abbreviations
 
-        self.dictionary = enchant.Dict("cs")
+        if abbreviations:
+            self.expander = AbbreviationExpander(load_expansions())
+
+        if correction_index is not None:
+            from utils.symspell import SymSpell
+            self.symspell = SymSpell(correction_index)
+        else:
+            self.symspell = None
+            self.dictionary = enchant.Dict("cs")
 
     def _roman_translate(self, match):
         output = match.group()
@@ -133,6 +145,15 @@ class TTSPreprocessor:
         output = re.sub(r'[-—―–‒−‐­=]+ ?>', ' šipka ', text)
         return output
 
+    def abbreviation_preprocessor(self, text):
+        """
+        Finds abbreviations and writes them in full.
+
+        :param text: text
+        :return: modified text
+        """
+        return self.expander.expand(text)
+
     def onlyascii(self, char):
         if ord(char) < 48 or ord(char) > 127:
             return ''
@@ -154,6 +175,45 @@ class TTSPreprocessor:
         return lev(text1, text2, insert_costs=insert_costs, delete_costs=delete_costs,
                    substitute_costs=substitute_costs)
 
+    def _check(self, word):
+        if self.symspell is not None:
+            return self.symspell.check(word)
+        return self.dictionary.check(word)
+
+    def _suggest(self, word):
+        if self.symspell is not None:
+            return self.symspell.suggest(word, self.distance)
+
+        suggestions = self.dictionary.suggest(word)
+        distances = map(lambda suggestion: self.distance(suggestion, word), suggestions)
+        return sorted(filter(lambda item: item[1] <= 2, zip(suggestions, distances)), key=lambda item: item[1])
+
+    def correct_word(self, word):
+        """
+        Checks a word against a dictionary and tries to correct it.
+
+        :param word: word
+        :return: corrected word or the original word if there is no unambiguous correction
+        """
+        if self._check(word):
+            return word
+
+        suggestions = self._suggest(word)
+
+        if len(suggestions) == 0:
+            logging.warning(f'no correction for {word}')
+            return word
+
+        min_distance = suggestions[0][1]
+        best = [suggestion for suggestion, distance in suggestions if distance == min_distance]
+
+        if len(best) > 1:
+            logging.warning(f'ambiguous correction for {word}')
+            logging.debug(f'corrections: {best}')
+            return word
+
+        return best[0]
+
     def autocorrect_preprocessor(self, text):
         """
         Checks each word againts a dictionary and tries to correct it.
@@ -169,33 +229,8 @@ class TTSPreprocessor:
             token = token.group()
             if len(token) == 1 and token[0] not in '-—―–‒−‐­0-9aábcčdďeéěfghiíjklmnňoópqrřsštťuúůvwxyýzž':
                 words.append(token)
-            elif self.dictionary.check(token):
-                words.append(token)
             else:
-                suggestions = self.dictionary.suggest(token)
-
-                if len(suggestions) == 0:
-                    logging.warning(f'no correction for {token}')
-                    words.append(token)
-                    continue
-
-                distances = list(map(lambda suggestion: self.distance(suggestion, token), suggestions))
-                min_distance = min(distances)
-
-                if min_distance > 2:
-                    logging.warning(f'no correction for {token}')
-                    words.append(token)
-                    continue
-
-                min_positions = [i for i, x in enumerate(distances) if x == min_distance]
-
-                if len(min_positions) > 1:
-                    logging.warning(f'ambiguous correction for {token}')
-                    logging.debug(f'corrections: {list(map(lambda idx: suggestions[idx], min_positions))}')
-                    words.append(token)
-                    continue
-
-                words.append(suggestions[min_positions[0]])
+                words.append(self.correct_word(token))
 
         return " ".join(words)
 
@@ -223,6 +258,8 @@ class TTSPreprocessor:
         output = text
         if self.full_names:
             output = self.name_preprocessor(output)
+        if self.abbreviations:
+            output = self.abbreviation_preprocessor(output)
         if self.use_roman:
             output = self.roman_preprocessor(output)
         if self.arrows: